@@ -1,14 +1,49 @@
 # ¤¤¤ Start of Final Code (Updated for New Documentation) ¤¤¤
+import asyncio
+import atexit
 import logging
+import logging.handlers
 import os
-import requests
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, EmailStr
-from requests.auth import HTTPBasicAuth
-from typing import Optional, List, Dict, Any
-
-# --- Basic Configuration (Unchanged) ---
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", handlers=[logging.FileHandler("zoom_and_ghl_processor.log"), logging.StreamHandler()])
+import queue
+import re
+import secrets
+import time
+import unicodedata
+from contextlib import asynccontextmanager
+import httpx
+import orjson
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, field_validator
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from typing import Optional, List, Dict, Any, AsyncIterator, FrozenSet, Tuple
+
+# Optional Rust-backed batch HTTP client (pip install rusty-req)
+try:
+    import rusty_req
+except ImportError:
+    rusty_req = None
+
+# Optional Redis client for sharing the Zoom token across workers (pip install redis)
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import RedisError
+    _REDIS_ERRORS = (RedisError, OSError)
+except ImportError:
+    aioredis = None
+    _REDIS_ERRORS = (OSError,)
+
+# --- Basic Configuration ---
+# File writes go through a queue drained on a background thread so they never block the event loop
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.FileHandler("zoom_and_ghl_processor.log"))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", handlers=[logging.handlers.QueueHandler(_log_queue), logging.StreamHandler()])
+logger = logging.getLogger(__name__)
+# httpx logs every request at INFO, which means one record per GHL webhook in the fan-out
+logging.getLogger("httpx").setLevel(logging.WARNING)
 if os.getenv("RENDER") is None:
     from dotenv import load_dotenv
     load_dotenv()
@@ -22,135 +57,709 @@ GHL_WEBHOOK_URL = os.getenv("GHL_WEBHOOK_URL")
 if not all([ZOOM_ACCOUNT_ID, ZOOM_CLIENT_ID, ZOOM_CLIENT_SECRET, ZOOM_WEBINAR_ID, GHL_WEBHOOK_URL]):
     raise RuntimeError("One or more required environment variables are missing.")
 
-app = FastAPI(title="Zoom & GHL Integration API")
+# --- Zoom Endpoints (the webinar ID is fixed for the life of the process) ---
+ZOOM_TOKEN_URL = "https://zoom.us/oauth/token"
+ZOOM_REGISTRANTS_URL = f"https://api.zoom.us/v2/webinars/{ZOOM_WEBINAR_ID}/registrants"
+# UPDATED: The endpoint URL now uses /past_webinars/ instead of /report/webinars/
+ZOOM_PARTICIPANTS_URL = f"https://api.zoom.us/v2/past_webinars/{ZOOM_WEBINAR_ID}/participants"
+# Bodies are pre-serialized with orjson, so the content type has to be set by hand
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# --- Tuning ---
+GHL_CONCURRENCY = int(os.getenv("GHL_CONCURRENCY", "20"))
+ZOOM_CONCURRENCY = int(os.getenv("ZOOM_CONCURRENCY", "10"))
+# Contacts per GHL POST; 1 sends one contact per call. Only raise this if the
+# receiving webhook accepts a {"contacts": [...]} body.
+GHL_BATCH_SIZE = int(os.getenv("GHL_BATCH_SIZE", "1"))
+# Hand the whole GHL fan-out to rusty-req in one call instead of one coroutine per contact
+GHL_RUST_CLIENT = os.getenv("GHL_RUST_CLIENT", "").lower() in ("1", "true", "yes")
+if GHL_RUST_CLIENT and rusty_req is None:
+    logger.warning("GHL_RUST_CLIENT is set but rusty-req is not installed; using the asyncio client.")
+# Redis (or Render Key Value) URL for a token cache shared by every worker/instance
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL and aioredis is None:
+    logger.warning("REDIS_URL is set but redis is not installed; using the in-process token cache.")
+
+# Caps in-flight GHL webhook calls so large fan-outs don't trigger 429s
+ghl_semaphore = asyncio.Semaphore(GHL_CONCURRENCY)
+# Same idea for Zoom: bulk registration calls and concurrent page fetches
+zoom_semaphore = asyncio.Semaphore(ZOOM_CONCURRENCY)
+
+# Recent Zoom outcomes (201 body or 409 detail) per normalized email, so repeat
+# submissions are answered without another round trip
+_registration_cache: TTLCache = TTLCache(maxsize=10000, ttl=3600)
 
-# --- Pydantic Model (Unchanged) ---
+# --- Shared Clients (pooled for keep-alive; opened and closed with the app lifespan) ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # retries=3 re-attempts failed connection setups; status-based retries live in _retry_policy
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0), retries=3)
+    app.state.http = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(10.0), headers={"User-Agent": "zoom-webinar-auto-registration"})
+    app.state.redis = aioredis.from_url(REDIS_URL) if REDIS_URL and aioredis is not None else None
+    yield
+    await app.state.http.aclose()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+# Renders response bodies with orjson (fastapi.responses.ORJSONResponse is deprecated)
+class OrjsonResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+app = FastAPI(title="Zoom & GHL Integration API", lifespan=lifespan, default_response_class=OrjsonResponse)
+
+# --- Email Validation ---
+# Precompiled syntactic check for the bulk endpoint; much cheaper than email-validator
+EMAIL_RE = re.compile(r"^[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,}$", re.I)
+# Permissive guard for single registrations: allows every RFC atext character and
+# non-ASCII addresses, but rejects leading, trailing and doubled dots
+REGISTRANT_EMAIL_RE = re.compile(r"(?!\.)(?!.*\.\.)[^@\s]+(?<!\.)@[^@\s]+\.[^@\s]+")
+
+# --- Pydantic Model ---
 class WebinarRegistrant(BaseModel):
-    email: EmailStr
+    email: str
     first_name: str
     last_name: Optional[str] = None
 
-# --- Zoom Authentication & Helpers ---
+    @field_validator("email")
+    @classmethod
+    def check_email(cls, value: str) -> str:
+        if not REGISTRANT_EMAIL_RE.fullmatch(value):
+            raise ValueError("value is not a valid email address")
+        return value
+
+# --- Email Normalization ---
+def norm_email(email: str) -> str:
+    # Nearly every address is ASCII, where NFKC is a no-op and casefold equals lower
+    if email.isascii():
+        return email.strip().lower()
+    # NFKC folds compatibility/composed variants; casefold also handles ß and dotted/dotless i
+    return unicodedata.normalize("NFKC", email).strip().casefold()
+
+# --- Retries & Circuit Breaking ---
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive 5xx/transport failures. While open,
+    # callers wait instead of failing; once `reset_timeout` passes a single trial call
+    # goes through (half-open) and the rest wait for its outcome. A caller gives up
+    # with CircuitOpenError only after waiting `max_wait` seconds.
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0, max_wait: float = 60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_wait = max_wait
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial: Optional[asyncio.Future] = None
+
+    async def before_call(self) -> bool:
+        # Returns True when this call is the half-open trial; it must then call end_trial()
+        deadline = time.monotonic() + self.max_wait
+        while self.opened_at is not None:
+            now = time.monotonic()
+            if self._trial is None and now - self.opened_at >= self.reset_timeout:
+                self._trial = asyncio.get_running_loop().create_future()
+                return True
+            if now >= deadline:
+                raise CircuitOpenError(f"{self.name} circuit is still open; giving up.")
+            if self._trial is not None:
+                await asyncio.wait([self._trial], timeout=deadline - now)
+            else:
+                await asyncio.sleep(min(self.reset_timeout - (now - self.opened_at), deadline - now))
+        return False
+
+    def end_trial(self):
+        # Wakes the waiters; they proceed if the trial closed the circuit, otherwise wait again
+        if self._trial is not None:
+            if not self._trial.done():
+                self._trial.set_result(None)
+            self._trial = None
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning("%s circuit opened after %d consecutive failures.", self.name, self.failures)
+            self.opened_at = time.monotonic()
+
+zoom_breaker = CircuitBreaker("Zoom")
+ghl_breaker = CircuitBreaker("GHL")
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exc, httpx.TransportError)
+
+def _is_outage(exc: BaseException) -> bool:
+    # 429 only means we're sending too fast; retries with Retry-After handle it, so it
+    # must not trip the breaker
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+_backoff = wait_exponential_jitter(initial=0.5, max=8)
 
-def get_zoom_access_token(): # Unchanged
-    token_url = "https://zoom.us/oauth/token"
+def _wait_for_retry(retry_state) -> float:
+    # Honour Zoom/GHL's Retry-After on 429s; otherwise back off exponentially with jitter
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429:
+        retry_after = exc.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), 60.0)
+    return _backoff(retry_state)
+
+_retry_policy = retry(stop=stop_after_attempt(4), wait=_wait_for_retry, retry=retry_if_exception(_is_retryable), reraise=True)
+
+def _is_safe_to_resend(exc: BaseException) -> bool:
+    # Registration POSTs aren't idempotent: a read timeout may follow a registration Zoom
+    # already made, so only resend on a retryable status or when the request never left
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+_registration_retry_policy = retry(stop=stop_after_attempt(4), wait=_wait_for_retry, retry=retry_if_exception(_is_safe_to_resend), reraise=True)
+
+async def _send_through_breaker(breaker: CircuitBreaker, send) -> httpx.Response:
+    is_trial = await breaker.before_call()
     try:
-        response = requests.post(token_url, auth=HTTPBasicAuth(ZOOM_CLIENT_ID, ZOOM_CLIENT_SECRET), params={"grant_type": "account_credentials", "account_id": ZOOM_ACCOUNT_ID})
+        response = await send()
         response.raise_for_status()
-        token_data = response.json()
-        logging.info("Successfully obtained Zoom access token.")
-        return token_data.get("access_token")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
+        if _is_outage(e):
+            breaker.record_failure()
+        raise
+    else:
+        breaker.record_success()
+        return response
+    finally:
+        if is_trial:
+            breaker.end_trial()
+
+# --- Zoom Authentication & Helpers ---
+# Hard cap on one token refresh, retries included, so it stays well inside the Redis lock TTL
+TOKEN_REFRESH_TIMEOUT = 20.0
+
+@_retry_policy
+async def _post_zoom_token() -> httpx.Response:
+    response = await app.state.http.post(ZOOM_TOKEN_URL, auth=httpx.BasicAuth(ZOOM_CLIENT_ID, ZOOM_CLIENT_SECRET), params={"grant_type": "account_credentials", "account_id": ZOOM_ACCOUNT_ID})
+    response.raise_for_status()
+    return response
+
+async def _request_zoom_token() -> Dict[str, Any]:
+    try:
+        response = await asyncio.wait_for(_post_zoom_token(), TOKEN_REFRESH_TIMEOUT)
+        token_data = orjson.loads(response.content)
+        logger.info("Successfully obtained Zoom access token.")
+        return token_data
+    except (httpx.HTTPError, orjson.JSONDecodeError, asyncio.TimeoutError) as e:
         raise HTTPException(status_code=500, detail="Could not authenticate with Zoom.")
 
-def _fetch_all_from_zoom(endpoint_url: str, headers: Dict[str, str], data_key: str) -> List[Dict[str, Any]]: # Unchanged
-    all_results = []
-    params = {"page_size": 300}
+# Zoom tokens live ~1 hour; reuse one until 60s before expiry. The lock makes
+# refresh single-flight, since a new token can invalidate the one in use.
+# The auth header dict is built once per refresh and shared by every call.
+_token_cache = {"value": None, "exp": 0.0, "headers": {}}
+_token_lock = asyncio.Lock()
+TOKEN_EXPIRY_SKEW = 60
+# Keyed by account and client so apps sharing one Redis never swap tokens
+ZOOM_TOKEN_REDIS_KEY = f"zoom:token:{ZOOM_ACCOUNT_ID}:{ZOOM_CLIENT_ID}"
+ZOOM_TOKEN_REDIS_LOCK_KEY = f"{ZOOM_TOKEN_REDIS_KEY}:lock"
+# Outlives the slowest possible refresh, so the lock can't expire under its holder
+ZOOM_TOKEN_REDIS_LOCK_TTL = int(TOKEN_REFRESH_TIMEOUT) + 10
+# Compare-and-delete: only the worker that set the lock may release it
+_RELEASE_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+def _load_token_record(cached: Optional[bytes]) -> Optional[Dict[str, Any]]:
+    # A missing or unreadable record just means the token has to be refreshed
+    if not cached:
+        return None
+    try:
+        return orjson.loads(cached)
+    except orjson.JSONDecodeError:
+        return None
+
+async def _read_shared_zoom_token() -> Optional[Tuple[str, float]]:
+    record = _load_token_record(await app.state.redis.get(ZOOM_TOKEN_REDIS_KEY))
+    if record:
+        # Stored as wall-clock time since monotonic clocks differ per process
+        remaining = record["exp"] - time.time()
+        if remaining > TOKEN_EXPIRY_SKEW:
+            return record["value"], remaining
+    return None
+
+async def _get_shared_zoom_token() -> Optional[Tuple[str, float]]:
+    # Returns (token, seconds left) from Redis. One worker refreshes under a SET NX lock
+    # while the others wait for it to publish; None means we gave up waiting.
+    # Waiters outlast the lock TTL, so if the holder dies one of them takes the lock over
+    # rather than minting a token outside it.
+    deadline = time.monotonic() + ZOOM_TOKEN_REDIS_LOCK_TTL + 5
+    lock_owner = secrets.token_hex(16)
     while True:
+        shared = await _read_shared_zoom_token()
+        if shared:
+            return shared
+        if await app.state.redis.set(ZOOM_TOKEN_REDIS_LOCK_KEY, lock_owner, nx=True, ex=ZOOM_TOKEN_REDIS_LOCK_TTL):
+            try:
+                # The previous holder may have published between our read and the SET NX
+                shared = await _read_shared_zoom_token()
+                if shared:
+                    return shared
+                token_data = await _request_zoom_token()
+                expires_in = int(token_data.get("expires_in", 3600))
+                record = {"value": token_data.get("access_token"), "exp": time.time() + expires_in}
+                await app.state.redis.set(ZOOM_TOKEN_REDIS_KEY, orjson.dumps(record), ex=expires_in)
+                return record["value"], expires_in
+            finally:
+                await app.state.redis.eval(_RELEASE_LOCK_SCRIPT, 1, ZOOM_TOKEN_REDIS_LOCK_KEY, lock_owner)
+        if time.monotonic() > deadline:
+            return None
+        await asyncio.sleep(0.2)
+
+async def get_zoom_auth_headers() -> Dict[str, str]:
+    if _token_cache["value"] and time.monotonic() < _token_cache["exp"] - TOKEN_EXPIRY_SKEW:
+        return _token_cache["headers"]
+    async with _token_lock:
+        # Another request may have refreshed while we waited on the lock
+        if _token_cache["value"] and time.monotonic() < _token_cache["exp"] - TOKEN_EXPIRY_SKEW:
+            return _token_cache["headers"]
+        shared = None
+        if app.state.redis is not None:
+            try:
+                shared = await _get_shared_zoom_token()
+            except _REDIS_ERRORS as e:
+                logger.warning("Redis token cache unavailable (%s); using the in-process cache.", e)
+        if shared:
+            access_token, expires_in = shared
+        else:
+            token_data = await _request_zoom_token()
+            access_token, expires_in = token_data.get("access_token"), int(token_data.get("expires_in", 3600))
+        _token_cache["value"] = access_token
+        _token_cache["exp"] = time.monotonic() + expires_in
+        _token_cache["headers"] = {"Authorization": f"Bearer {access_token}"}
+        return _token_cache["headers"]
+
+async def invalidate_zoom_token(stale_headers: Dict[str, str]) -> Dict[str, str]:
+    # Called on a 401: drop the token if it is still the one that failed, then fetch a fresh one
+    async with _token_lock:
+        if _token_cache["headers"] == stale_headers:
+            stale_token = _token_cache["value"]
+            _token_cache.update(value=None, exp=0.0, headers={})
+            if app.state.redis is not None:
+                try:
+                    record = _load_token_record(await app.state.redis.get(ZOOM_TOKEN_REDIS_KEY))
+                    if record and record.get("value") == stale_token:
+                        await app.state.redis.delete(ZOOM_TOKEN_REDIS_KEY)
+                except _REDIS_ERRORS as e:
+                    logger.warning("Could not clear the shared Zoom token (%s).", e)
+            logger.warning("Zoom rejected the cached access token; refreshing it.")
+    return await get_zoom_auth_headers()
+
+@_retry_policy
+async def _zoom_get(endpoint_url: str, headers: Dict[str, str], params: Dict[str, Any]) -> httpx.Response:
+    return await _send_through_breaker(zoom_breaker, lambda: app.state.http.get(endpoint_url, headers=headers, params=params))
+
+_compression_logged = False
+
+def _log_compression_once(response: httpx.Response):
+    # One-off check that Zoom actually compresses the large list pages we request
+    global _compression_logged
+    if not _compression_logged:
+        _compression_logged = True
+        logger.info("Zoom page encoding=%s: %d bytes on the wire, %d bytes decoded.", response.headers.get("Content-Encoding", "identity"), response.num_bytes_downloaded, len(response.content))
+
+async def _fetch_zoom_page(endpoint_url: str, headers: Dict[str, str], params: Dict[str, Any], data_key: str) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    # Also returns the auth headers that worked, so a 401 refresh carries over to later pages
+    try:
         try:
-            response = requests.get(endpoint_url, headers=headers, params=params)
-            response.raise_for_status()
-            data = response.json()
-            results_on_page = data.get(data_key, [])
-            all_results.extend(results_on_page)
+            response = await _zoom_get(endpoint_url, headers, params)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 401:
+                raise
+            # The token was revoked or replaced elsewhere; retry once with a fresh one
+            headers = await invalidate_zoom_token(headers)
+            response = await _zoom_get(endpoint_url, headers, params)
+        _log_compression_once(response)
+        return orjson.loads(response.content), headers
+    except (httpx.HTTPError, orjson.JSONDecodeError, CircuitOpenError) as e:
+        raise HTTPException(status_code=502, detail=f"Failed to fetch {data_key} from Zoom.")
+
+async def _iter_zoom_pages(endpoint_url: str, headers: Dict[str, str], data_key: str) -> AsyncIterator[List[Dict[str, Any]]]:
+    params = {"page_size": 300}
+    data, headers = await _fetch_zoom_page(endpoint_url, headers, params, data_key)
+    page_count = data.get("page_count") or 1
+    # The next request is always in flight before a page is yielded, so the network
+    # wait overlaps with whatever the caller does with the current page
+    pending: Optional[asyncio.Future] = None
+    try:
+        # Endpoints that still honour page_number let us fetch pages 2..N at once
+        if page_count > 1 and "page_number" in data:
+            async def fetch_page(page_number: int) -> Dict[str, Any]:
+                nonlocal headers
+                # Bounded so a long list doesn't throttle itself
+                async with zoom_semaphore:
+                    page, headers = await _fetch_zoom_page(endpoint_url, headers, {**params, "page_number": page_number}, data_key)
+                    return page
+
+            pending = asyncio.ensure_future(asyncio.gather(*[fetch_page(page_number) for page_number in range(2, page_count + 1)]))
+            yield data.get(data_key, [])
+            for page in await pending:
+                yield page.get(data_key, [])
+            return
+
+        # Otherwise walk the next_page_token cursor, prefetching one page ahead
+        while True:
             next_page_token = data.get("next_page_token")
-            if next_page_token:
-                params["next_page_token"] = next_page_token
-            else:
-                break
-        except requests.exceptions.RequestException as e:
-            raise HTTPException(status_code=502, detail=f"Failed to fetch {data_key} from Zoom.")
-    return all_results
-
-# UPDATED: Function to get participants aligned with new documentation
-def get_all_past_webinar_participants(webinar_id: str, access_token: str) -> List[Dict[str, Any]]:
-    logging.info(f"Fetching all PARTICIPANTS for past webinar {webinar_id}...")
-    # UPDATED: The endpoint URL now uses /past_webinars/ instead of /report/webinars/
-    url = f"https://api.zoom.us/v2/past_webinars/{webinar_id}/participants"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    participants = _fetch_all_from_zoom(url, headers, "participants")
-    logging.info(f"Found {len(participants)} total participants.")
-    return participants
-
-def get_all_webinar_registrants(webinar_id: str, access_token: str) -> List[Dict[str, Any]]: # Unchanged
-    logging.info(f"Fetching all REGISTRANTS for webinar {webinar_id}...")
-    url = f"https://api.zoom.us/v2/webinars/{webinar_id}/registrants"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    registrants = _fetch_all_from_zoom(url, headers, "registrants")
-    logging.info(f"Found {len(registrants)} total registrants.")
-    return registrants
-
-# --- Unchanged GHL and Registration Helpers ---
-def register_person_for_webinar(webinar_id: str, registrant_data: Dict[str, Any], access_token: str) -> Dict[str, Any]: # Unchanged
-    logging.info(f"Attempting to register {registrant_data.get('email')} for webinar {webinar_id}...")
-    url = f"https://api.zoom.us/v2/webinars/{webinar_id}/registrants"
-    headers = {"Authorization": f"Bearer {access_token}"}
+            pending = asyncio.ensure_future(_fetch_zoom_page(endpoint_url, headers, {**params, "next_page_token": next_page_token}, data_key)) if next_page_token else None
+            yield data.get(data_key, [])
+            if pending is None:
+                return
+            data, headers = await pending
+    finally:
+        # Don't leave a prefetch running if the caller stops early
+        if pending is not None and not pending.done():
+            pending.cancel()
+
+async def _iter_zoom_items(endpoint_url: str, headers: Dict[str, str], data_key: str) -> AsyncIterator[Dict[str, Any]]:
+    async for page in _iter_zoom_pages(endpoint_url, headers, data_key):
+        for item in page:
+            yield item
+
+async def _stream_emails_from_zoom(endpoint_url: str, headers: Dict[str, str], data_key: str, email_keys: Tuple[str, ...]) -> AsyncIterator[str]:
+    # Yields normalized emails page by page so the raw dicts can be dropped as soon as they're read
+    async for page in _iter_zoom_pages(endpoint_url, headers, data_key):
+        for person in page:
+            for key in email_keys:
+                if person.get(key):
+                    email = norm_email(person[key])
+                    # Whitespace-only values normalize to "" and must never match anyone
+                    if email:
+                        yield email
+
+# UPDATED: Participants are reduced to a set of normalized emails while streaming
+async def get_past_webinar_participant_emails(headers: Dict[str, str]) -> FrozenSet[str]:
+    logger.info("Fetching all PARTICIPANTS for past webinar %s...", ZOOM_WEBINAR_ID)
+    # Zoom may put the address under either key
+    participant_emails = frozenset([email async for email in _stream_emails_from_zoom(ZOOM_PARTICIPANTS_URL, headers, "participants", ("user_email", "email"))])
+    logger.info("Found %d unique participant emails.", len(participant_emails))
+    return participant_emails
+
+# --- GHL and Registration Helpers ---
+@_registration_retry_policy
+async def _post_registrant(body: bytes, headers: Dict[str, str]) -> httpx.Response:
+    response = await app.state.http.post(ZOOM_REGISTRANTS_URL, headers={**headers, **_JSON_HEADERS}, content=body)
+    # Only throttling/5xx are retried; 401 and 4xx answers go back to the caller as-is
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        response.raise_for_status()
+    return response
+
+def _error_detail(response: httpx.Response) -> Any:
+    # Gateways in front of Zoom answer 429/5xx with HTML or an empty body
     try:
-        response = requests.post(url, headers=headers, json=registrant_data)
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return response.text or response.reason_phrase
+
+async def register_person_for_webinar(registrant_data: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    logger.info("Attempting to register %s for webinar %s...", registrant_data.get("email"), ZOOM_WEBINAR_ID)
+    cache_key = norm_email(registrant_data["email"])
+    cached = _registration_cache.get(cache_key)
+    if cached is not None:
+        status_code, payload = cached
+        logger.info("Returning cached Zoom %d for %s.", status_code, registrant_data["email"])
+        if status_code == 201:
+            return payload
+        raise HTTPException(status_code=status_code, detail=payload)
+    try:
+        body = orjson.dumps(registrant_data)
+        try:
+            response = await _post_registrant(body, headers)
+            if response.status_code == 401:
+                # The token was revoked or replaced elsewhere; retry once with a fresh one
+                headers = await invalidate_zoom_token(headers)
+                response = await _post_registrant(body, headers)
+        except httpx.HTTPStatusError as e:
+            # Still throttled/failing after the retries; pass Zoom's own status through
+            response = e.response
         if response.status_code != 201:
-            error_details = response.json()
+            error_details = _error_detail(response)
+            if response.status_code == 409:
+                _registration_cache[cache_key] = (409, error_details)
             raise HTTPException(status_code=response.status_code, detail=error_details)
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        data = orjson.loads(response.content)
+        _registration_cache[cache_key] = (201, data)
+        return data
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
         raise HTTPException(status_code=502, detail="Failed to communicate with Zoom for registration.")
 
-def send_to_ghl_webhook(contact_data: Dict[str, Any]): # Unchanged
-    try:
-        response = requests.post(GHL_WEBHOOK_URL, json=contact_data)
-        response.raise_for_status()
-        logging.info(f"Successfully sent {contact_data['email']} to GHL webhook.")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to send data for {contact_data['email']} to GHL: {e}")
+@_retry_policy
+async def _ghl_post(client: httpx.AsyncClient, body: bytes) -> httpx.Response:
+    return await _send_through_breaker(ghl_breaker, lambda: client.post(GHL_WEBHOOK_URL, content=body, headers=_JSON_HEADERS))
+
+async def send_to_ghl_webhook(client: httpx.AsyncClient, contact_data: Dict[str, Any]) -> Optional[int]:
+    # Returns the GHL status code (None on transport errors) so callers can tally throttling
+    async with ghl_semaphore:
+        try:
+            response = await _ghl_post(client, orjson.dumps(contact_data))
+            logger.debug("Sent %s to GHL webhook attended=%s", contact_data["email"], contact_data.get("attended"))
+            return response.status_code
+        except httpx.HTTPStatusError as e:
+            logger.error("Failed to send data for %s to GHL: %s", contact_data["email"], e)
+            return e.response.status_code
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.error("Failed to send data for %s to GHL: %s", contact_data["email"], e)
+            return None
+
+async def send_batch_to_ghl(client: httpx.AsyncClient, payloads: List[Dict[str, Any]], batch_state: Dict[str, bool]) -> List[Optional[int]]:
+    # Returns one status per contact so batched and per-item runs tally the same way.
+    # batch_state is shared by one processing run; "rejected" makes its later batches
+    # skip the doomed bulk POST once GHL has refused the array form.
+    if batch_state["rejected"]:
+        return await asyncio.gather(*[send_to_ghl_webhook(client, payload) for payload in payloads])
+    async with ghl_semaphore:
+        try:
+            response = await _ghl_post(client, orjson.dumps({"contacts": payloads}))
+            logger.debug("Successfully sent batch of %d contacts to GHL webhook.", len(payloads))
+            return [response.status_code] * len(payloads)
+        except httpx.HTTPStatusError as e:
+            status_code = e.response.status_code
+            if not (400 <= status_code < 500 and status_code != 429):
+                logger.error("Failed to send batch of %d contacts to GHL: %s", len(payloads), e)
+                return [status_code] * len(payloads)
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.error("Failed to send batch of %d contacts to GHL: %s", len(payloads), e)
+            return [None] * len(payloads)
+
+    # A 4xx means the webhook rejected this batch; resend contact by contact. 413 only
+    # says the batch was too big, so it doesn't rule out the array form for the run.
+    if status_code != 413:
+        batch_state["rejected"] = True
+    logger.warning("GHL rejected a batch of %d contacts (%d); falling back to per-contact posts.", len(payloads), status_code)
+    return await asyncio.gather(*[send_to_ghl_webhook(client, payload) for payload in payloads])
+
+async def send_all_to_ghl_rust(payloads: List[Dict[str, Any]]) -> List[Optional[int]]:
+    # rusty-req runs the batch on its own Tokio pool with its own concurrency, so the
+    # semaphore, retries and circuit breaker above don't apply on this path.
+    requests_payload = [
+        rusty_req.RequestItem(url=GHL_WEBHOOK_URL, method="POST", params=payload, tag=payload["email"], timeout=30.0)
+        for payload in payloads
+    ]
+    results = await rusty_req.fetch_requests(requests_payload, total_timeout=120.0, mode=rusty_req.ConcurrencyMode.JOIN_ALL)
+    statuses: List[Optional[int]] = []
+    for result in results:
+        exception = result.get("exception") or {}
+        if exception.get("type"):
+            logger.error("Failed to send data for %s to GHL: %s %s", (result.get("meta") or {}).get("tag"), exception.get("type"), exception.get("message"))
+        # rusty-req reports 0 when no response arrived; treat it like a transport error
+        statuses.append(result.get("http_status") or None)
+    sent_count = sum(1 for status in statuses if status is not None and status < 400)
+    if sent_count:
+        logger.info("Sent %d of %d contacts to GHL webhook via rusty-req.", sent_count, len(payloads))
+    return statuses
 
 # --- API Endpoints ---
 @app.post("/register-webinar", status_code=201)
-async def register_webinar_attendee(registrant: WebinarRegistrant): # Unchanged
-    access_token = get_zoom_access_token()
+async def register_webinar_attendee(registrant: WebinarRegistrant):
+    zoom_headers = await get_zoom_auth_headers()
     registrant_payload = registrant.model_dump(exclude_unset=True)
-    zoom_response = register_person_for_webinar(
-        webinar_id=ZOOM_WEBINAR_ID, registrant_data=registrant_payload, access_token=access_token
-    )
+    zoom_response = await register_person_for_webinar(registrant_data=registrant_payload, headers=zoom_headers)
     return {"message": "Registration successful.", "registrant_id": zoom_response.get("registrant_id"), "join_url": zoom_response.get("join_url")}
 
-# UPDATED: Main processing endpoint with corrected logic
-@app.post("/process-registrants")
-async def process_all_registrants():
-    logging.info("--- Starting Full Post-Webinar Segmentation Processing ---")
-    access_token = get_zoom_access_token()
-    
-    # 1. Get both lists from Zoom
-    all_registrants = get_all_webinar_registrants(ZOOM_WEBINAR_ID, access_token)
-    all_participants = get_all_past_webinar_participants(ZOOM_WEBINAR_ID, access_token) # UPDATED: Calls the renamed function
-    
-    # 2. Create a set of participant emails for fast lookups
-    # UPDATED: The email field in the participants list is 'user_email'
-    participant_emails = {person['user_email'] for person in all_participants if 'user_email' in person}
-    
-    # 3. Process every registrant (Logic is unchanged)
+async def _register_one(registrant_payload: Dict[str, Any], zoom_headers: Dict[str, str]) -> Dict[str, Any]:
+    async with zoom_semaphore:
+        try:
+            zoom_response = await register_person_for_webinar(registrant_data=registrant_payload, headers=zoom_headers)
+        except HTTPException as e:
+            return {"email": registrant_payload["email"], "status_code": e.status_code, "detail": e.detail}
+        except Exception:
+            # One bad row must not fail the whole gather and lose the rows that did register
+            logger.exception("Unexpected error while registering %s.", registrant_payload["email"])
+            return {"email": registrant_payload["email"], "status_code": 500, "detail": "Unexpected error during registration."}
+    return {"email": registrant_payload["email"], "registrant_id": zoom_response.get("registrant_id"), "join_url": zoom_response.get("join_url")}
+
+@app.post("/register-webinar/bulk")
+async def register_webinar_attendees_bulk(registrants: List[Dict[str, Any]]):
+    # Validate with the precompiled regex up front instead of building a model per row
+    valid_payloads = []
+    invalid = []
+    for row in registrants:
+        email = row.get("email")
+        first_name = row.get("first_name")
+        if not isinstance(email, str) or not EMAIL_RE.fullmatch(email) or not isinstance(first_name, str) or not first_name:
+            invalid.append({"email": email, "detail": "A valid email and first_name are required."})
+            continue
+        payload = {"email": email, "first_name": first_name}
+        if isinstance(row.get("last_name"), str):
+            payload["last_name"] = row["last_name"]
+        valid_payloads.append(payload)
+
+    zoom_headers = await get_zoom_auth_headers()
+    results = await asyncio.gather(*[_register_one(payload, zoom_headers) for payload in valid_payloads])
+    registered = [r for r in results if "registrant_id" in r]
+    failed = [r for r in results if "registrant_id" not in r]
+    logger.info("Bulk registration: %d registered, %d failed, %d invalid.", len(registered), len(failed), len(invalid))
+    return {"registered": registered, "failed": failed, "invalid": invalid}
+
+# UPDATED: Segmentation job, run in the background by /process-registrants
+async def _do_process() -> Optional[str]:
+    logger.info("--- Starting Full Post-Webinar Segmentation Processing ---")
+    # Nobody is waiting on the response anymore, so Zoom failures are logged instead of raised
+    try:
+        zoom_headers = await get_zoom_auth_headers()
+    except HTTPException as e:
+        logger.error("Post-webinar processing aborted: %s", e.detail)
+        return None
+
+    # 1. Start building the participant email set while registrant pages stream in
+    participants_task = asyncio.ensure_future(get_past_webinar_participant_emails(zoom_headers))
+    participant_emails: Optional[FrozenSet[str]] = None
+    client = app.state.http
+    use_rust = GHL_RUST_CLIENT and rusty_req is not None
+
     attended_count = 0
     noshow_count = 0
-    for registrant in all_registrants:
-        email = registrant.get("email")
-        if not email:
-            continue
+    registrant_count = 0
+    duplicates_skipped = 0
+    seen_emails = set()
+    # (task, contacts it carries), so a batch that raises counts every contact as failed
+    send_tasks: List[Tuple[asyncio.Future, int]] = []
+    pending_batch: List[Dict[str, Any]] = []
+    batch_state = {"rejected": False}
+    rust_payloads: List[Dict[str, Any]] = []
+    # Rows without a first name wait for a later duplicate row to fill it in; Zoom
+    # requires first_name, so this is rare. Unfilled rows go out at the end.
+    held_for_name: Dict[str, Dict[str, Any]] = {}
+    aborted = False
 
-        status = 1 if email in participant_emails else 0
-        
-        if status == 1:
-            attended_count += 1
+    def dispatch(contact_payload: Dict[str, Any]):
+        nonlocal pending_batch
+        if use_rust:
+            rust_payloads.append(contact_payload)
+        elif GHL_BATCH_SIZE > 1:
+            pending_batch.append(contact_payload)
+            if len(pending_batch) >= GHL_BATCH_SIZE:
+                send_tasks.append((asyncio.ensure_future(send_batch_to_ghl(client, pending_batch, batch_state)), len(pending_batch)))
+                pending_batch = []
         else:
-            noshow_count += 1
-            
-        contact_payload = {
-            "first_name": registrant.get("first_name"),
-            "last_name": registrant.get("last_name", ""),
-            "email": email,
-            "attended": status
-        }
-        send_to_ghl_webhook(contact_payload)
-        
+            send_tasks.append((asyncio.ensure_future(send_to_ghl_webhook(client, contact_payload)), 1))
+
+    logger.info("Fetching all REGISTRANTS for webinar %s...", ZOOM_WEBINAR_ID)
+    try:
+        async for registrant in _iter_zoom_items(ZOOM_REGISTRANTS_URL, zoom_headers, "registrants"):
+            registrant_count += 1
+            if participant_emails is None:
+                participant_emails = await participants_task
+
+            # 2. Zoom can list the same person more than once; keep the first row per normalized email
+            email = registrant.get("email")
+            normalized_email = norm_email(email) if email else None
+            if not normalized_email:
+                continue
+            if normalized_email in seen_emails:
+                duplicates_skipped += 1
+                if normalized_email in held_for_name and registrant.get("first_name"):
+                    held = held_for_name.pop(normalized_email)
+                    held["first_name"] = registrant["first_name"]
+                    held["last_name"] = held["last_name"] or registrant.get("last_name") or ""
+                    dispatch(held)
+                continue
+            seen_emails.add(normalized_email)
+
+            # 3. Classify and dispatch to GHL right away, while later Zoom pages are still in flight
+            status = 1 if normalized_email in participant_emails else 0
+            if status == 1:
+                attended_count += 1
+            else:
+                noshow_count += 1
+
+            contact_payload = {
+                "first_name": registrant.get("first_name"),
+                "last_name": registrant.get("last_name") or "",
+                "email": email,
+                "attended": status
+            }
+            if contact_payload["first_name"]:
+                dispatch(contact_payload)
+            else:
+                held_for_name[normalized_email] = contact_payload
+        if participant_emails is None:
+            # No registrants at all; still surface a failed participants fetch
+            participant_emails = await participants_task
+    except HTTPException as e:
+        logger.error("Post-webinar processing aborted: %s", e.detail)
+        aborted = True
+    finally:
+        if not participants_task.done():
+            participants_task.cancel()
+
+    if not aborted:
+        logger.info("Found %d total registrants.", registrant_count)
+        if duplicates_skipped:
+            logger.info("Skipped duplicate registrants: duplicates_skipped=%d", duplicates_skipped)
+        for contact_payload in held_for_name.values():
+            dispatch(contact_payload)
+        if pending_batch:
+            send_tasks.append((asyncio.ensure_future(send_batch_to_ghl(client, pending_batch, batch_state)), len(pending_batch)))
+        if rust_payloads:
+            send_tasks.append((asyncio.ensure_future(send_all_to_ghl_rust(rust_payloads)), len(rust_payloads)))
+
+    # Let already-dispatched sends finish even when the Zoom side failed part-way
+    gathered = await asyncio.gather(*[task for task, _ in send_tasks], return_exceptions=True)
+    if aborted:
+        return None
+    # Batched and rusty-req sends return one status per contact. gather(return_exceptions=True)
+    # hands back unexpected errors as values; report them instead of raising.
+    results = []
+    unexpected_errors = []
+    errored_contacts = 0
+    for result, (_, contact_count) in zip(gathered, send_tasks):
+        if isinstance(result, BaseException):
+            unexpected_errors.append(result)
+            errored_contacts += contact_count
+        elif isinstance(result, list):
+            results.extend(result)
+        else:
+            results.append(result)
+    throttled_count = sum(1 for r in results if r == 429)
+    server_error_count = sum(1 for r in results if isinstance(r, int) and r >= 500)
+    if throttled_count or server_error_count:
+        logger.warning("GHL returned %d x 429 and %d x 5xx at concurrency %d.", throttled_count, server_error_count, GHL_CONCURRENCY)
+    for error in unexpected_errors:
+        logger.error("Unexpected error while sending to GHL: %r", error)
+    failed_count = errored_contacts + sum(1 for r in results if not isinstance(r, int) or r >= 400)
+
     summary = f"Processing complete. Sent {attended_count} attendees and {noshow_count} no-shows to GHL."
-    logging.info(summary)
-    
-    return {"message": "Full segmentation processing complete.", "summary": summary}
+    if failed_count:
+        summary += f" {failed_count} deliveries failed."
+    logger.info(summary)
+    return summary
+
+# UPDATED: Returns 202 right away; the Zoom fetches and GHL fan-out run after the response is sent
+@app.post("/process-registrants", status_code=202)
+async def process_all_registrants(background_tasks: BackgroundTasks):
+    background_tasks.add_task(_do_process)
+    return {"message": "Post-webinar segmentation processing queued.", "status": "queued"}
+
+# --- Entrypoint ---
+# uvloop and httptools ship with uvicorn[standard]; equivalent to
+# `uvicorn main:app --loop uvloop --http httptools --workers $WEB_CONCURRENCY`
+if __name__ == "__main__":
+    import uvicorn
+    # One worker per core only when Redis shares the Zoom token; otherwise each
+    # worker would mint its own token and invalidate the others'
+    default_workers = (os.cpu_count() or 1) if REDIS_URL and aioredis is not None else 1
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", str(default_workers))),
+    )
 # ¤¤¤ End of Final Code (Updated for New Documentation) ¤¤¤
\ No newline at end of file